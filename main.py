@@ -6,6 +6,183 @@ MEIGA-SR:
 Program to detect retrotransposon integrations from pair end sequencing data
 """
 
+###############
+## Constants ##
+###############
+
+## MEIGA-SR config options and the configuration dictionary keys they populate
+CONFIG_KEYS = {
+	'reference': ['reference'],
+	'refDir': ['refDir'],
+	'species': ['species'],
+	'build': ['build'],
+	'annovarDir': ['annovarDir'],
+	'germlineMEI': ['germlineMEI'],
+	'targetBins': ['targetBins'],
+	'binSize': ['binSize'],
+	'noDuplicates': ['filterDup'],
+	'readFilters': ['readFilters'],
+	'minMAPQ': ['minMAPQ'],
+	'minCLIPPINGlen': ['minCLIPPINGlen'],
+	'refs': ['refs'],
+	'minClusterSize': ['minClusterSize', 'minNbDISCORDANT', 'minNbCLIPPING'],
+	'maxClusterSize': ['maxClusterSize'],
+	'BKPdist': ['maxBkpDist'],
+	'minPercOverlap': ['minPercRcplOverlap'],
+	'equalOrientBuffer': ['equalOrientBuffer'],
+	'oppositeOrientBuffer': ['oppositeOrientBuffer'],
+	'minReads': ['minReads'],
+	'minNormalReads': ['minNormalReads'],
+	'minReadsRegionMQ': ['minReadsRegionMQ'],
+	'maxRegionlowMQ': ['maxRegionlowMQ'],
+	'maxRegionSMS': ['maxRegionSMS'],
+	'wgsData': ['retroTestWGS'],
+	'blatClip': ['blatClip'],
+	'transductionEnds': ['tdEnds'],
+	'sourceBed': ['srcBed'],
+	'srcFamilies': ['srcFamilies'],
+}
+
+## Config option types. Options not listed are kept as strings
+INT_KEYS = {'binSize', 'minMAPQ', 'minCLIPPINGlen', 'minClusterSize', 'maxClusterSize', 'BKPdist', 'minPercOverlap', 'equalOrientBuffer', 'oppositeOrientBuffer', 'minReads', 'minNormalReads'}
+FLOAT_KEYS = {'minReadsRegionMQ', 'maxRegionlowMQ', 'maxRegionSMS'}
+BOOL_KEYS = {'noDuplicates', 'wgsData', 'blatClip'}
+LIST_KEYS = {'readFilters', 'transductionEnds', 'srcFamilies'}
+NONE_KEYS = {'germlineMEI', 'targetBins', 'sourceBed'}
+
+
+###############
+## Functions ##
+###############
+
+def none_if_unset(value):
+	'''
+	Return None for config values set to 'none', otherwise the value itself
+	'''
+	return None if value == 'none' else value
+
+
+def to_bool(value):
+	'''
+	Convert a config value to boolean following configparser conventions (yes/no, on/off, true/false, 1/0)
+	'''
+	if isinstance(value, bool):
+		return value
+
+	from configparser import ConfigParser
+	state = ConfigParser.BOOLEAN_STATES.get(str(value).lower())
+
+	if state is None:
+		raise ValueError('Not a boolean: %s' % value)
+
+	return state
+
+
+def to_int(value):
+	'''
+	Convert a config value to integer. Booleans and non integral numbers (i.e. TOML values) are rejected instead of truncated
+	'''
+	if isinstance(value, bool) or (isinstance(value, float) and not value.is_integer()):
+		raise ValueError('Not an integer: %s' % value)
+
+	return int(value)
+
+
+def to_list(value):
+	'''
+	Convert a comma separated config value (or a TOML array) into a list. Empty items (i.e. trailing commas) are discarded
+	'''
+	items = value if isinstance(value, list) else value.split(',')
+
+	return [item for item in (str(item).strip() for item in items) if item]
+
+
+def to_refs(value):
+	'''
+	Convert the refs config value into a list of reference names. 'ALL' is kept as it is
+	'''
+	refs = to_list(value)
+
+	return 'ALL' if refs == ['ALL'] else refs
+
+
+def looks_like_toml(content):
+	'''
+	Check if config content has TOML only values (quoted strings or arrays), which configparser would silently misparse
+	'''
+	import re
+
+	return re.search(rb'^\s*\w+\s*=\s*["\'\[]', content, re.MULTILINE) is not None
+
+
+def read_toml_config(content, section='MEIGA-SR'):
+	'''
+	Parse a config section from TOML formatted content
+
+	Input:
+		1. content: config file content as bytes
+		2. section: section (table) to be returned
+
+	Output:
+		1. config: dictionary with the section options (already typed) or None if content is not TOML
+		(i.e. legacy INI config)
+
+	Malformed TOML content raises tomllib.TOMLDecodeError (with line and column) instead of falling back to configparser
+	'''
+	try:
+		import tomllib
+
+	except ImportError:
+		if looks_like_toml(content):
+			raise RuntimeError('TOML config files require python >= 3.11 (tomllib). Use an INI config file instead')
+
+		return None
+
+	try:
+		config = tomllib.loads(content.decode())
+
+	except tomllib.TOMLDecodeError:
+		if looks_like_toml(content):
+			raise
+
+		return None
+
+	except UnicodeDecodeError:
+		return None
+
+	return config.get(section)
+
+
+def get_refs_fast(bam):
+	'''
+	Get the list of references in a BAM file reading only its header
+
+	Unlike bamtools.get_refs, the index is not loaded and @SQ lines are not validated
+
+	Input:
+		1. bam: path to BAM file
+
+	Output:
+		1. refs: list of reference names in the same order as in the header
+	'''
+	import pysam
+
+	with pysam.AlignmentFile(bam, 'rb', check_sq=False, require_index=False) as bamFile:
+		refs = list(bamFile.references)
+
+	return refs
+
+
+## Config option -> type conversion function
+CONVERTERS = {}
+CONVERTERS.update(dict.fromkeys(INT_KEYS, to_int))
+CONVERTERS.update(dict.fromkeys(FLOAT_KEYS, float))
+CONVERTERS.update(dict.fromkeys(BOOL_KEYS, to_bool))
+CONVERTERS.update(dict.fromkeys(LIST_KEYS, to_list))
+CONVERTERS.update(dict.fromkeys(NONE_KEYS, none_if_unset))
+CONVERTERS['refs'] = to_refs
+
+
 if __name__ == '__main__':
 	
 	VERSION = '1.1.0'
@@ -16,26 +193,51 @@ if __name__ == '__main__':
  
 	## 1. Check program dependencies are satisfied 
 	################################################
+	import sys
+	import os
+	import hashlib
+	import time
+	from pathlib import Path
 	from GAPI import check_dependencies as cd
 	from GAPI import log
 
-	missingDependencies = cd.missing_python_dependencies() or cd.missing_program_dependencies()
-	if missingDependencies: exit(1)
+	# Per-user cache for dependency checks and parsed configurations. Set MEIGA_NO_CACHE to disable
+	cacheDir = os.path.join(os.path.expanduser('~'), '.cache', 'meiga')
+	useCache = not os.environ.get('MEIGA_NO_CACHE')
+
+	# A successful check is reused for 24h for the same python interpreter and PATH
+	depsFile = None
+	depsChecked = False
+
+	if useCache:
+
+		# A missing marker or interpreter path (i.e. embedded python) is a cache miss
+		try:
+			depsKey = hashlib.blake2b((sys.executable + str(os.path.getmtime(sys.executable)) + os.environ.get('PATH', '')).encode(), digest_size=16).hexdigest()
+			depsFile = os.path.join(cacheDir, 'deps_' + depsKey + '.ok')
+			depsChecked = time.time() - os.path.getmtime(depsFile) < 24 * 3600
+		except OSError:
+			pass
+
+	if not depsChecked:
+		missingDependencies = cd.missing_python_dependencies() or cd.missing_program_dependencies()
+		if missingDependencies: exit(1)
+
+		# Remember the successful check. Caching is best effort
+		if depsFile:
+			try:
+				os.makedirs(cacheDir, exist_ok=True)
+				Path(depsFile).touch()
+			except OSError:
+				pass
 
 	# External
 	import argparse
-	import sys
-	import os
-	import multiprocessing as mp
-	import configparser
-	import time
+	import pickle
+	import tempfile
 	from datetime import datetime
 	import logging
 
-	# Internal
-	from GAPI import bamtools
-	from modules import caller
-
 	######################
 	## Get user's input ##
 	######################
@@ -47,6 +249,9 @@ if __name__ == '__main__':
 
 	## 1. Define parser
 	######################
+	# Default number of processes: CPUs available to this process
+	availableCPUs = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else (os.cpu_count() or 1)
+
 	parser = argparse.ArgumentParser()
 
 	### Define subcommands 
@@ -63,7 +268,7 @@ if __name__ == '__main__':
 	# B. Optional arguments
 	call.add_argument('--normalBam', default=None, dest='normalBam', help='Matched normal bam file. If provided MEIGA will run in PAIRED mode')
 	call.add_argument('-o', '--outDir', default=os.getcwd(), dest='outDir', help='Output directory. Default: current working directory')
-	call.add_argument('-p', '--processes', default=1, dest='processes', type=int, help='Number of processes. Default: 1')
+	call.add_argument('-p', '--processes', default=None, dest='processes', type=int, help='Number of processes. Default: number of available CPUs (' + str(availableCPUs) + ')')
 	call.add_argument('-d', '--debug', action='store_true', dest='debug', help='Debug mode')
 	call.add_argument('--predict', action='store_true', dest='predict', help='Apply ML classifier to output')
 
@@ -74,36 +279,41 @@ if __name__ == '__main__':
 	# B. Optional arguments
 	call_tds.add_argument('--normalBam', default=None, dest='normalBam', help='Matched normal bam file. If provided MEIGA will run in PAIRED mode')
 	call_tds.add_argument('-o', '--outDir', default=os.getcwd(), dest='outDir', help='Output directory. Default: current working directory')
-	call_tds.add_argument('-p', '--processes', default=1, dest='processes', type=int, help='Number of processes. Default: 1')
+	call_tds.add_argument('-p', '--processes', default=None, dest='processes', type=int, help='Number of processes. Default: number of available CPUs (' + str(availableCPUs) + ')')
 	call_tds.add_argument('-d', '--debug', action='store_true', dest='debug', help='Debug mode')
 
 	### Set method features
 	scriptName = os.path.basename(sys.argv[0])
 	scriptName = os.path.splitext(scriptName)[0]
 
-	mp.set_start_method('spawn')
-
 
 	## 2. Parse user's input
 	##########################
 	args = parser.parse_args()
+	timeStamp = datetime.now().strftime("%Y%m%d%H%M%S") if args.debug else None
 	configFile = args.config
 	bam = args.bam
 	normalBam = args.normalBam
-	processes = args.processes
+	processes = args.processes if args.processes is not None else availableCPUs
+
+	# Heavy modules (multiprocessing, pysam, caller) are imported only
+	# once arguments are validated, so --help and argument errors return immediately
+	import multiprocessing as mp
+
+	# forkserver keeps the isolation of spawn, but expensive modules are imported once
+	# in the server process instead of in every worker
+	mp.set_start_method('forkserver')
+	mp.set_forkserver_preload(['pysam', 'numpy', 'GAPI.bamtools', 'modules.caller'])
 	
 	
 	## 2.1. Set output dir
 	##########################
-	outDir = args.outDir
-
 	# if debug, use outDir/timeStamp as the output directory
-	if args.debug:
-		timeStamp = str(datetime.now().strftime("%Y%m%d%H%M%S"))
-		outDir = args.outDir + '/' + timeStamp
+	outDir = os.path.join(args.outDir, timeStamp) if args.debug else args.outDir
+	logDir = outDir + '/logs'
 
-	# create output dir
-	os.makedirs(outDir, exist_ok=True)
+	# create output and log dirs
+	os.makedirs(logDir, exist_ok=True)
 
   
 	## 2.2. Determine running mode
@@ -113,76 +323,90 @@ if __name__ == '__main__':
   
 	## 2.3. Create configuration dictionary
 	###########################################
+	# Parsed configuration is cached by config file content and this script's source (which covers the
+	# version and the parsing code), so repeated runs with the same profile skip parsing
+	with open(configFile, 'rb') as configHandle:
+		configContent = configHandle.read()
+
+	with open(os.path.abspath(__file__), 'rb') as sourceHandle:
+		configHash = hashlib.sha256(sourceHandle.read() + configContent).hexdigest()
+
+	cacheFile = os.path.join(cacheDir, configHash + '.pkl')
+	configDict = None
+
+	if useCache and os.path.isfile(cacheFile):
+
+		# An unreadable or corrupted entry (i.e. partially written by another run) is ignored and the config parsed again
+		try:
+			with open(cacheFile, 'rb') as cacheHandle:
+				configDict = pickle.load(cacheHandle)
+		except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, IndexError, TypeError, ValueError):
+			configDict = None
+
+	if configDict is None:
+		configDict = {}
+
+		# TOML config files are parsed with tomllib. INI files fall back to configparser
+		raw = read_toml_config(configContent)
+
+		if raw is None:
+			import configparser
+			meigaConfig = configparser.ConfigParser(inline_comment_prefixes = ('#'))
+			meigaConfig.read(configFile)
+
+			# Take a single snapshot of the section. Options are case insensitive in INI files
+			section = dict(meigaConfig['MEIGA-SR'])
+			raw = {option: section[meigaConfig.optionxform(option)] for option in CONFIG_KEYS if meigaConfig.optionxform(option) in section}
+
+		# Convert each option once
+		for option, keys in CONFIG_KEYS.items():
+			value = raw.get(option)
+
+			if value is not None:
+				try:
+					value = CONVERTERS.get(option, str)(value)
+				except (ValueError, TypeError, AttributeError) as error:
+					raise ValueError('Invalid value for config option %s: %s' % (option, error)) from error
+
+			for key in keys:
+				configDict[key] = value
+
+		# Store parsed configuration for next runs. Caching is best effort. The entry is written
+		# to a temporary file and then moved into place, so concurrent runs never load a partial file
+		if useCache:
+			tmpFile = None
+
+			try:
+				os.makedirs(cacheDir, exist_ok=True)
+				with tempfile.NamedTemporaryFile('wb', dir=cacheDir, suffix='.tmp', delete=False) as tmpHandle:
+					tmpFile = tmpHandle.name
+					pickle.dump(configDict, tmpHandle)
+				os.replace(tmpFile, cacheFile)
+
+			except OSError:
+				if tmpFile and os.path.exists(tmpFile):
+					try:
+						os.remove(tmpFile)
+					except OSError:
+						pass
+
 	confDict = {}
-	meigaConfig = configparser.ConfigParser(inline_comment_prefixes = ('#'))
-	meigaConfig.read(configFile)
-	config = meigaConfig['MEIGA-SR']
 
 	### General
-	reference = config.get('reference')
-	refDir = config.get('refDir')
+	reference = configDict.pop('reference')
+	refDir = configDict.pop('refDir')
+	refs = configDict.pop('refs')
 	confDict['source'] = 'MEIGA-SR-' + VERSION
-	confDict['species'] = config.get('species')
-	confDict['build'] = config.get('build')
-	confDict['annovarDir'] = config.get('annovarDir')
-	confDict['germlineMEI'] = None if config.get('germlineMEI') == 'none' else config.get('germlineMEI')
+	confDict.update(configDict)
 	confDict['processes'] = processes
 	confDict['debug'] = args.debug
 	confDict['predict'] = args.predict
-
-	### BAM processing
-	confDict['targetBins'] = None if config.get('targetBins') == 'none' else config.get('targetBins')
-	confDict['binSize'] = config.getint('binSize')
-	confDict['filterDup'] = config.getboolean('noDuplicates')
-	confDict['readFilters'] = [filt.strip() for filt in config.get('readFilters').split(',')]
-	confDict['minMAPQ'] = config.getint('minMAPQ')
-	confDict['minCLIPPINGlen'] = config.getint('minCLIPPINGlen')
 	confDict['targetEvents'] = ['DISCORDANT', 'CLIPPING']
 
-	### Target refs
-	refs = config.get('refs')
-	if refs == 'ALL': refs = bamtools.get_refs(bam) # If "ALL" specified, get all refs in bam file
-	targetRefs = [ref.strip() for ref in refs.split(',')]
-	confDict['targetRefs'] = targetRefs
-
-	### Clustering
-	confDict['minClusterSize'] = config.getint('minClusterSize')
-	confDict['maxClusterSize'] = config.getint('maxClusterSize')
-	confDict['maxBkpDist'] = config.getint('BKPdist')
-	confDict['minPercRcplOverlap'] = config.getint('minPercOverlap')
-	confDict['equalOrientBuffer'] = config.getint('equalOrientBuffer')
-	confDict['oppositeOrientBuffer'] = config.getint('oppositeOrientBuffer')
-
-	### Filtering thresholds
-	confDict['minReads'] = config.getint('minReads')
-	confDict['minNormalReads'] = config.getint('minNormalReads')
-	confDict['minNbDISCORDANT'] = config.getint('minClusterSize')
-	confDict['minNbCLIPPING'] = config.getint('minClusterSize')
-	confDict['minReadsRegionMQ'] = config.getfloat('minReadsRegionMQ')
-	confDict['maxRegionlowMQ'] = config.getfloat('maxRegionlowMQ')
-	confDict['maxRegionSMS'] = config.getfloat('maxRegionSMS')
-
-	### Transduction search
-	confDict['retroTestWGS'] = config.getboolean('wgsData')
-	confDict['blatClip'] = config.getboolean('blatClip')
-	confDict['tdEnds'] = [tdEnd.strip() for tdEnd in config.get('transductionEnds').split(',')]
-	confDict['srcBed'] = None if config.get('sourceBed') == 'none' else config.get('sourceBed')
-	confDict['srcFamilies'] = [family.strip() for family in config.get('srcFamilies').split(',')]
-
-	# In debug mode the output is the specified dir + data_time
-	if args.debug:
-		outDir = args.outDir + "/"+str( datetime.now().strftime("%Y%m%d%H%M%S") ) 
-	else:
-		outDir = args.outDir
-
-	# create  output and log dirs
-	logDir = outDir + '/logs'
+	### Output
 	confDict['outDir'] = outDir
 	confDict['logDir'] = logDir
 
-	os.makedirs(outDir, exist_ok=True)
-	os.makedirs(logDir, exist_ok=True)
-
 
 	## 2.5 Initialize log system
 	##############################
@@ -190,23 +414,43 @@ if __name__ == '__main__':
 	logFile = logDir + '/main.log'
 	logFormat = '%(asctime)s - %(name)s - %(levelname)s - %(message)s' 
 	logger = log.setup_logger(logName, logFile, logFormat, level=logging.DEBUG, consoleLevel=logging.WARNING)
+
+
+	## 2.6 Set target refs
+	############################
+	bamRefs = get_refs_fast(bam)
+
+	# If "ALL" specified, get all refs in bam header
+	if refs == 'ALL':
+		targetRefs = bamRefs
+
+	# Otherwise discard duplicated refs and refs absent from the bam header, so the caller does not run useless passes
+	else:
+		validRefs = set(bamRefs)
+		unknownRefs = [ref for ref in refs if ref not in validRefs]
+
+		if unknownRefs:
+			logger.warning('Target refs not found in bam header will be skipped: %s', ', '.join(unknownRefs))
+
+		targetRefs = list(dict.fromkeys(ref for ref in refs if ref in validRefs))
+
+		if not targetRefs:
+			logger.error('None of the target refs is present in the bam header: %s', bam)
+			exit(1)
+
+	confDict['targetRefs'] = targetRefs
         
 
 	## 3. Display configuration to standard output
 	################################################
-	logger.info('***** ' + scriptName + ' ' + VERSION + ' configuration *****')
-	logger.info('*** Arguments ***')
+	if args.processes is None:
+		logger.info('Number of processes not provided. Using all available CPUs: %s', processes)
+
+	# Each block is emitted as a single multi-line record
 	subcommand = 'call-tds' if args.call_tds else 'call'
-	logger.info('subcommand: ' + subcommand)
-	logger.info('config file: ' + configFile)
-	logger.info('bam: '+  bam)
-	logger.info('normalBam: ' + str(normalBam))
-	logger.info('outDir: ' + outDir)
-	logger.info('processes: ' + str(processes) + '\n\n')
-	logger.info('*** ConfigDict ***')
-	for key, value in confDict.items():
-		logger.info(key + ' => ' + str(value))
-	logger.info('\n\n')
+	logger.info('***** %s %s configuration *****\n*** Arguments ***\nsubcommand: %s\nconfig file: %s\nbam: %s\nnormalBam: %s\noutDir: %s\nprocesses: %s\n\n',
+		scriptName, VERSION, subcommand, configFile, bam, normalBam, outDir, processes)
+	logger.info('*** ConfigDict ***\n%s\n\n', '\n'.join('%s => %s' % (key, value) for key, value in confDict.items()))
 
   
 	## 4. Check all required DB are located in the dirs provided
@@ -218,7 +462,8 @@ if __name__ == '__main__':
 	########################
 	## Execute MEI caller ##
 	########################
-	
+	from modules import caller
+
 	# If 'call-tds' running mode selected
 	if args.call_tds:
 		# execute transductions caller
@@ -236,6 +481,6 @@ if __name__ == '__main__':
 	############
 	
 	timeCounter = round((time.time()-start)/60, 4)
-	logger.info('***** Finished! in ' + str(timeCounter) + 'minutes *****\n')
+	logger.info('***** Finished! in %sminutes *****\n', timeCounter)
 
 